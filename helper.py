@@ -3,6 +3,13 @@ import matplotlib.pyplot as plt
 from sklearn.model_selection import train_test_split
 
 
+# memory budget for the temporary squared distances of a block of kernel rows
+KERNEL_BLOCK_BYTES = 16 * 1024 * 1024
+
+# fewest rows per block, so the distance computation stays a matrix-matrix product
+MIN_BLOCK_ROWS = 256
+
+
 class LabelledDataset():
     
     def __init__(self, dataset):
@@ -11,6 +18,135 @@ class LabelledDataset():
         self.size = self.data.shape[0]
         self.labels = dataset[:,0]
         
+
+def squared_distances(x1, x2, x2sq=None):
+    """
+    Compute squared Euclidean distances between all pairs of rows of x1 and x2,
+    using ||x-y||^2 = ||x||^2 + ||y||^2 - 2x.y so that the bulk of the work is a single matrix product.
+    
+    -- Input --
+    x1: [n1, datadim] array
+    x2: [n2, datadim] array
+    x2sq: [n2] array -- squared norms of x2, computed if not given
+    
+    -- Return --
+    sqdist: [n1, n2] array -- squared distances
+    """
+    
+    x1sq = np.einsum('ij,ij->i', x1, x1)
+    if x2sq is None:
+        x2sq = np.einsum('ij,ij->i', x2, x2)
+    
+    sqdist = x1sq[:, None] + x2sq[None, :]
+    sqdist -= 2 * np.dot(x1, np.transpose(x2))
+    
+    # clip negative values caused by rounding
+    np.maximum(sqdist, 0, out=sqdist)
+    
+    return sqdist
+
+
+def integer_power(base, degree):
+    """
+    Raise base element-wise to a non-negative integer power by repeated squaring,
+    which avoids the per-element pow() call of np.power.
+    
+    -- Input --
+    base: array
+    degree: int -- non-negative exponent
+    
+    -- Return --
+    result: array -- base**degree
+    """
+    
+    degree = int(degree)
+    if degree == 0:
+        return np.ones_like(base)
+    
+    result = None
+    while True:
+        if degree & 1:
+            result = base.copy() if result is None else np.multiply(result, base, out=result)
+        degree >>= 1
+        if not degree:
+            return result
+        base = base * base
+
+
+def polynomial_kernel(x1, x2, degree):
+    """
+    Compute polynomial kernel matrix (x.y)^degree in single precision, the
+    precision used by the kernel perceptron.
+    
+    -- Input --
+    x1: [n1, datadim] array
+    x2: [n2, datadim] array
+    degree: int or float -- polynomial degree
+    
+    -- Return --
+    K: [n1, n2] float32 array -- kernel matrix
+    """
+    
+    gram = np.dot(x1, np.transpose(x2)).astype(np.float32)
+    
+    # use repeated multiplication for integer degrees
+    if float(degree).is_integer() and degree >= 0:
+        return integer_power(gram, degree)
+    
+    return np.power(gram, degree)
+
+
+def gaussian_kernels(x1, x2, param_set, block_rows=None):
+    """
+    Compute Gaussian kernel matrices exp(-param * ||x-y||^2) for several parameters
+    in blocks of rows of x1. The squared distances of every block are computed once
+    and shared by all parameters, and the kernels are written into single precision
+    output matrices, so no full-size double precision temporaries are created.
+    
+    -- Input --
+    x1: [n1, datadim] array
+    x2: [n2, datadim] array
+    param_set: list or arr -- Gaussian kernel width parameters
+    block_rows: int -- rows per block, chosen from KERNEL_BLOCK_BYTES if not given
+    
+    -- Return --
+    Klist: list of [n1, n2] float32 arrays -- kernel matrix for every parameter
+    """
+    
+    Klist = [np.empty((x1.shape[0], x2.shape[0]), dtype=np.float32) for param in param_set]
+    
+    # a block of squared distances should take at most KERNEL_BLOCK_BYTES,
+    # but keep enough rows for an efficient matrix product
+    if block_rows is None:
+        block_rows = max(MIN_BLOCK_ROWS, KERNEL_BLOCK_BYTES // (8 * x2.shape[0]))
+    
+    x2sq = np.einsum('ij,ij->i', x2, x2)
+    
+    for start in range(0, x1.shape[0], block_rows):
+        stop = start + block_rows
+        sqdist = squared_distances(x1[start:stop], x2, x2sq)
+        for param, K in zip(param_set, Klist):
+            np.exp(-param * sqdist, out=K[start:stop])
+            
+    return Klist
+
+
+def gaussian_kernel(x1, x2, param, block_rows=None):
+    """
+    Compute Gaussian kernel matrix exp(-param * ||x-y||^2), see gaussian_kernels.
+    
+    -- Input --
+    x1: [n1, datadim] array
+    x2: [n2, datadim] array
+    param: float -- Gaussian kernel width parameter
+    block_rows: int -- rows per block, chosen from KERNEL_BLOCK_BYTES if not given
+    
+    -- Return --
+    K: [n1, n2] float32 array -- kernel matrix
+    """
+    
+    return gaussian_kernels(x1, x2, [param], block_rows)[0]
+
                
 def make_kernel_dict(data, kernel_func, param_set):
     """
@@ -35,13 +171,13 @@ def make_kernel_dict(data, kernel_func, param_set):
     # calculate polynomial kernel matrix for different parameters
     if kernel_func == 'polynomial':
         for param in param_set:
-            Kdict[str(param)] = np.power(np.dot(data, np.transpose(data)), param)
+            Kdict[str(param)] = polynomial_kernel(data, data, param)
             
     # calculate Gaussian kernel matrix for different parameters
     elif kernel_func == 'Gaussian':
-        dist = cdist(data, data, 'euclidean')
-        for param in param_set:
-            Kdict[str(param)] = np.exp(-param * np.power(dist, 2))
+        Klist = gaussian_kernels(data, data, param_set)
+        for param, K in zip(param_set, Klist):
+            Kdict[str(param)] = K
             
     return Kdict
                
@@ -1,14 +1,188 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.spatial.distance import cdist
+
+from helper import gaussian_kernel, polynomial_kernel
+
+
+# per-core data cache that the in-block replay state of a training block should fit in
+L1_CACHE_BYTES = 32 * 1024
+
+
+def _block_size(nrows, kernel_itemsize=4, delta_itemsize=2):
+    """
+    Largest power of two block size for which the state of the point-by-point
+    replay within a training block fits in L1 cache: the block_size x block_size
+    kernel tile, the block confidences and the block updates. This does not
+    count the operands of the block's matrix product (block_size x nsupport
+    kernel rows and nrows x nsupport coefficients), which grow with the number
+    of support vectors and are streamed through the cache once per block.
+    
+    -- Input --
+    nrows: int -- number of classifier rows
+    kernel_itemsize: int -- bytes per kernel entry
+    delta_itemsize: int -- bytes per classifier entry
+    
+    -- Return --
+    block_size: int -- number of data points per block (at least 16)
+    """
+    
+    block_size = 16
+    while True:
+        size = 2 * block_size
+        working_set = size * size * kernel_itemsize + size * nrows * (kernel_itemsize + delta_itemsize)
+        if working_set > L1_CACHE_BYTES:
+            return block_size
+        block_size = size
+
+
+def _pack_symmetric(kernel_mtx, indices):
+    """
+    Store the upper triangle of the symmetric kernel sub-matrix for the given
+    lookup indices row by row, in half the memory of the full sub-matrix.
+    
+    -- Input --
+    kernel_mtx: [n, n] array -- symmetric kernel matrix
+    indices: [datasize] int array -- lookup indices
+    
+    -- Return --
+    packed: [datasize*(datasize+1)/2] float32 array -- packed upper triangle
+    """
+    
+    datasize = indices.size
+    packed = np.empty(datasize * (datasize + 1) // 2, dtype=np.float32)
+    
+    for row in range(datasize):
+        offset = _packed_offset(row, datasize)
+        packed[offset:offset + datasize - row] = kernel_mtx[indices[row], indices[row:]]
+        
+    return packed
+
+
+def _packed_offset(row, datasize):
+    """
+    Position of the diagonal element of row (int or int array) in a packed upper triangle
+    """
+    return row * datasize - row * (row - 1) // 2
+
+
+def _unpack_rows(packed, datasize, start, stop):
+    """
+    Unpack rows start:stop of a symmetric matrix stored by _pack_symmetric.
+    
+    -- Input --
+    packed: [datasize*(datasize+1)/2] array -- packed upper triangle
+    datasize: int -- size of the symmetric matrix
+    start, stop: int -- range of rows
+    
+    -- Return --
+    K_rows: [stop-start, datasize] array -- unpacked rows
+    """
+    
+    rows = np.arange(start, stop)
+    K_rows = np.empty((stop - start, datasize), dtype=packed.dtype)
+    
+    # columns left of the block are stored in the rows of those columns
+    cols = np.arange(start)
+    K_rows[:, :start] = packed[(_packed_offset(cols, datasize) - cols)[None, :] + rows[:, None]]
+    
+    # columns from the diagonal onwards are stored contiguously
+    for row in range(start, stop):
+        offset = _packed_offset(row, datasize)
+        K_rows[row - start, row:] = packed[offset:offset + datasize - row]
+        
+    # mirror the upper triangle of the diagonal block
+    block = K_rows[:, start:stop]
+    lower = np.tril_indices(stop - start, -1)
+    block[lower] = block.T[lower]
+    
+    return K_rows
+
+
+def _update(confidence, target):
+    """
+    Perceptron update for a single data point.
+    
+    -- Input --
+    confidence: [nrows] array -- confidence of every classifier row
+    target: [nrows] int array -- +1/-1 if the true class is on the positive/negative side of a row, 0 if not involved
+    
+    -- Return --
+    update: [nrows] int array -- target for wrongly predicted rows, 0 otherwise
+    """
+    
+    wrong = (confidence > 0) != (target > 0)
+    
+    return target * wrong
+
+
+def _epoch(classifier, kernel_rows, targets, support, block_size, test_confidence, K_test):
+    """
+    Run one online perceptron epoch, updating classifier in-place.
+    
+    Data points are processed in blocks: the confidences of a whole block are
+    computed with one matrix product against the support vectors, after which
+    the block is replayed point by point, correcting each confidence for the
+    updates made earlier in the same block. This gives exactly the same
+    updates as the plain online algorithm. The test set confidences are kept
+    up to date with the updates of every block.
+    
+    -- Input --
+    classifier: [nrows, datasize] array -- perceptron coefficients
+    kernel_rows: function -- maps (start, stop) to rows start:stop of the training kernel matrix
+    targets: [datasize, nrows] int array -- per data point targets (see _update)
+    support: [datasize] bool array -- (superset of) the columns with a non-zero coefficient
+             (support vectors), compacted to the exact support in-place
+    block_size: int -- number of data points per block
+    test_confidence: [nrows, testsize] array -- test set confidences, updated in-place
+    K_test: [datasize, testsize] array -- kernel between training and test set
+    
+    -- Return --
+    mistakes: int -- number of mistakes made during the epoch
+    """
+    
+    datasize = targets.shape[0]
+    mistakes = 0
+    
+    for start in range(0, datasize, block_size):
+        stop = min(start + block_size, datasize)
+        
+        # confidences of the block for the classifier at the start of the block
+        K_rows = kernel_rows(start, stop)
+        sv = np.flatnonzero(support)
+        block_confidence = K_rows[:, sv] @ classifier[:, sv].T
+        
+        # updates made within the block, one row per data point
+        delta = np.zeros((stop - start, classifier.shape[0]), dtype=classifier.dtype)
+        K_block = K_rows[:, start:stop]
+        
+        for offset in range(stop - start):
+            
+            # correct confidence for the earlier updates in this block
+            confidence = block_confidence[offset] + K_block[offset, :offset] @ delta[:offset]
+            delta[offset] = _update(confidence, targets[start + offset])
+            
+        mistakes += int(np.count_nonzero(delta))
+        classifier[:, start:stop] += delta.T
+        
+        # add new support vectors and drop columns whose coefficients returned to zero
+        support[start:stop] = np.any(classifier[:, start:stop] != 0, axis=0)
+        
+        # only data points with an update change the test set confidences
+        changed = np.flatnonzero(np.any(delta != 0, axis=1))
+        test_confidence += delta[changed].T @ K_test[start + changed]
+        
+    return mistakes
 
 
 class Kernel_perceptron:
     
-    def __init__(self, dataset, test_set, train_indices, test_indices, nclasses, kernel_mtx, kernel_param, classification_method='OvA'):
+    def __init__(self, dataset, test_set, train_indices, test_indices, nclasses, kernel_mtx, kernel_param, classification_method='OvA', packed_kernel=False):
         """
         Initialize perceptron with polynomial or Gaussian kernel, that uses a One-vs-All (OvA) or One-vs-One (OvO) classification method.
         
@@ -20,6 +194,8 @@ class Kernel_perceptron:
         nclasses -- number of classification classes
         kernel_mtx -- pre-computed kernel matrix
         classification_method -- 'OvA' or 'OvO' (One-vs-All or One-vs-One)
+        packed_kernel -- store the training kernel as a packed upper triangle, which halves its
+                         memory at the cost of unpacking it during training
         """
         
         # data
@@ -29,82 +205,158 @@ class Kernel_perceptron:
         
         # kernel
         self.kernel_mtx = kernel_mtx
-        self.train_indices = np.transpose(train_indices.reshape(1,-1))
+        self.train_indices = np.ascontiguousarray(train_indices).ravel()
         self.test_indices = test_indices
         self.kernel_param = kernel_param
         
+        # lookup training kernel once (kernels are used in single precision, which halves the
+        # memory traffic); if the training indices are a contiguous range and kernel_mtx is
+        # already float32 (as made by make_kernel_dict) this is a view, otherwise a copy
+        first, last = self.train_indices.min(), self.train_indices.max() + 1
+        self._K_train = None
+        self._K_packed = None
+        if np.array_equal(self.train_indices, np.arange(first, last)):
+            self._K_train = kernel_mtx[first:last, first:last].astype(np.float32, copy=False)
+        elif packed_kernel:
+            self._K_packed = _pack_symmetric(kernel_mtx, self.train_indices)
+        else:
+            self._K_train = kernel_mtx[np.ix_(self.train_indices, self.train_indices)].astype(np.float32, copy=False)
+        
+        # lookup kernel between training and test set once
+        self._K_test = kernel_mtx[np.ix_(self.train_indices, test_indices)].astype(np.float32, copy=False)
+        self._test_confidence = None
+        self._predictions = None
+        
+        # training points with a non-zero coefficient in any classifier row (support vectors)
+        self.support_mask = np.zeros(self.dataset.size, dtype=bool)
+        
         # classification
         self.classification_method = classification_method
 
+        # classifiers hold integer mistake counts and are stored column-major,
+        # so the coefficients of a data point are contiguous
+        
         # One-vs-All classification
         if self.classification_method == 'OvA':
-            self.classifier = np.zeros((self.nclasses, self.dataset.size))
+            self.classifier = np.zeros((self.nclasses, self.dataset.size), dtype=np.int16, order='F')
         
         # One-vs-One classification
         elif self.classification_method == 'OvO':
             k = self.nclasses
-            self.classifier = np.zeros((int(k*(k-1)/2), self.dataset.size))
+            self.classifier = np.zeros((int(k*(k-1)/2), self.dataset.size), dtype=np.int16, order='F')
             self.OvO_indices = []
             for idx1 in range(self.nclasses-1):
                 for idx2 in range(idx1+1, self.nclasses):
                     self.OvO_indices.append((idx1, idx2))
-                    
+            
+            # positive and negative class of every pair as arrays
+            self.ovo_a = np.array([pair[0] for pair in self.OvO_indices])
+            self.ovo_b = np.array([pair[1] for pair in self.OvO_indices])
+            
+            # indicator matrix adding the confidence of every pair to its positive
+            # class and subtracting it from its negative class
+            npairs = len(self.OvO_indices)
+            self._V = np.zeros((npairs, self.nclasses), dtype=np.float32)
+            self._V[np.arange(npairs), self.ovo_a] = 1
+            self._V[np.arange(npairs), self.ovo_b] = -1
+        
+        # precompute the target of every classifier row for every training point:
+        # +1/-1 if its label is on the positive/negative side of the row, 0 if not involved
+        labels = self.dataset.labels.astype(np.int64)[:, None]
+        if self.classification_method == 'OvA':
+            self._targets = np.where(np.arange(self.nclasses) == labels, 1, -1).astype(np.int8)
+        elif self.classification_method == 'OvO':
+            self._targets = (self.ovo_a == labels).astype(np.int8) - (self.ovo_b == labels)
         
        
-    def train(self, max_epochs, epsilon=1e-5):
+    def train(self, max_epochs, epsilon=1e-5, patience=1, block_size=None, n_jobs=1):
+        
+        if patience < 1:
+            raise ValueError("patience must be at least 1, got %r" % patience)
+        
+        test_confidence = self._confidence()
+        
+        # every classifier row is an independent binary perceptron, so the rows can be
+        # split in chunks that are trained in parallel threads. The per-point replay in
+        # _epoch holds the GIL, so threads only pay off for the dense kernel when the
+        # block matrix products dominate (large training sets with many support vectors);
+        # by default a single chunk is trained in the calling thread, and n_jobs < 1 uses
+        # all cores
+        nrows = self.classifier.shape[0]
+        if n_jobs is None:
+            n_jobs = 1
+        elif n_jobs < 1:
+            n_jobs = os.cpu_count() or 1
+        n_jobs = min(n_jobs, nrows)
+        
+        # every thread would unpack the same kernel rows again
+        if n_jobs > 1 and self._K_packed is not None:
+            raise ValueError("n_jobs > 1 is not supported with packed_kernel=True")
+        row_chunks = [slice(rows[0], rows[-1] + 1) for rows in np.array_split(np.arange(nrows), n_jobs)]
+        
+        # size training blocks so the in-block replay state fits in L1, based on the rows per thread
+        if block_size is None:
+            block_size = _block_size(-(-nrows // n_jobs), delta_itemsize=self.classifier.itemsize)
+            
+        def run_epoch(rows):
+            support = self.support_mask.copy()
+            mistakes = _epoch(self.classifier[rows], self._kernel_rows, self._targets[:, rows], support,
+                              block_size, test_confidence[rows], self._K_test)
+            return mistakes, support
+        
+        # one thread pool for all epochs, only if more than one thread is asked for
+        executor = ThreadPoolExecutor(n_jobs) if n_jobs > 1 else None
+        
+        try:
+            return self._train_epochs(max_epochs, epsilon, patience, run_epoch, row_chunks, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+                
+                
+    def _train_epochs(self, max_epochs, epsilon, patience, run_epoch, row_chunks, executor):
+        """
+        Run training epochs until convergence or max_epochs, see train
+        """
         
         trainErrors_ = []
         testErrors_ = []
         
-        # compute kernel matrix
-        K = self.kernel_mtx[self.train_indices, np.transpose(self.train_indices)]
-        
         # init values
-        prev_train_error = float('inf')
-        prev_test_error = float('inf')
+        train_error_history = []
+        best_test_error = float('inf')
         
         for epoch in range(max_epochs):
             
-            mistakes = 0
-            
             # online learning
-            for data_idx, data_point in enumerate(self.dataset.data):
-
-                # compute confidence
-                confidence = np.dot(self.classifier, K[data_idx,:])
-
-                # One-vs-All classification
-                if self.classification_method == 'OvA':
-                    for this_class in range(self.nclasses):
-                        if confidence[this_class] > 0 and this_class != self.dataset.labels[data_idx]:
-                            mistakes += 1
-                            self.classifier[this_class, data_idx] -= 1
-
-                        elif confidence[this_class] <= 0 and this_class == self.dataset.labels[data_idx]:
-                            mistakes += 1
-                            self.classifier[this_class, data_idx] += 1
+            if executor is None:
+                results = [run_epoch(rows) for rows in row_chunks]
+            else:
+                results = list(executor.map(run_epoch, row_chunks))
+            mistakes = sum(result[0] for result in results)
+            
+            # a column is a support vector if it is one for any chunk of rows
+            self.support_mask = np.logical_or.reduce([result[1] for result in results])
                 
-                # One-vs-One classification                            
-                elif self.classification_method == 'OvO':
-                    for class_idx, this_pair in enumerate(self.OvO_indices):
-                        if this_pair[0] == self.dataset.labels[data_idx] and confidence[class_idx] <= 0:
-                            mistakes += 1
-                            self.classifier[class_idx, data_idx] += 1
-                            
-                        if this_pair[1] == self.dataset.labels[data_idx] and confidence[class_idx] > 0:
-                            mistakes += 1
-                            self.classifier[class_idx, data_idx] -= 1
+            # classifier has changed, so drop cached predictions
+            self._predictions = None
                             
             # compute train and test errors
             train_error = mistakes/self.dataset.size
             test_error = self.test_error()
             
+            # converged if the train error did not improve on the last `patience` epochs
+            # or the test error rose above the best one so far
+            stalled = len(train_error_history) >= patience and \
+                      train_error > min(train_error_history[-patience:]) - epsilon
+            overfitting = test_error > best_test_error + 1e3*epsilon
+            
             # if converged, return misclassification error
-            if prev_train_error - train_error  <  epsilon or test_error > prev_test_error + 1e3*epsilon:
+            if stalled or overfitting:
                 return train_error
             else:
-                prev_train_error = train_error
-                prev_test_error = test_error
+                train_error_history.append(train_error)
+                best_test_error = min(best_test_error, test_error)
                 
 #             testErrors_.append(test_error)
 #             trainErrors_.append(train_error)
@@ -123,59 +375,64 @@ class Kernel_perceptron:
         """
         
         if self.kernel_func == 'polynomial':
-            return np.power(np.dot(x1, np.transpose(x2)), self.kernel_param)
+            return polynomial_kernel(x1, x2, self.kernel_param)
         
         if self.kernel_func == 'Gaussian':
-            
-            # compute distance between each pair of inputs
-            xdist = cdist(x1, x2, 'euclidean')            
-            
-            return np.exp(-self.kernel_param * np.power(xdist, 2))
+            return gaussian_kernel(x1, x2, self.kernel_param)
 
         
+    def _kernel_rows(self, start, stop):
+        """
+        Rows start:stop of the training kernel matrix
+        """
+        
+        if self._K_train is not None:
+            return self._K_train[start:stop]
+        
+        return _unpack_rows(self._K_packed, self.dataset.size, start, stop)
+    
+    
+    def _confidence(self):
+        """
+        Confidences of every classifier row on the test set, cached and kept
+        up to date by train
+        """
+        
+        if self._test_confidence is None:
+            sv = np.flatnonzero(self.support_mask)
+            self._test_confidence = np.dot(self.classifier[:, sv], self._K_test[sv])
+            
+        return self._test_confidence
+    
+    
     def predict(self, test_points):
         """
-        Predict class of test_point
+        Predict class of test_point. Predictions are cached until the next training epoch,
+        so test_error, confusion_matrix and count_mistake_vec share them.
         """
         
-        # lookup kernel from kernel matrix
-        K = self.kernel_mtx[self.train_indices, np.transpose(self.test_indices)]
-                
+        if self._predictions is not None:
+            return self._predictions
+        
         # predict confidences for every class
-        confidence = np.dot(self.classifier, K)
+        confidence = self._confidence()
         
         # if 1vsAll, return the maximized confidence
         if self.classification_method == 'OvA':
             decisions = np.argmax(confidence, axis=0)
-            return decisions
         
         # if 1vs1
         elif self.classification_method == 'OvO':
             
-            # calculate all decisions
-            confidence = np.transpose(confidence)
-            decisions = np.zeros(confidence.shape[0])
-            
-            # loop through all confidences
-            for this_dat in range(confidence.shape[0]):
+            # score every class by the summed signed confidences of its pairs
+            # instead of hard votes, so classes with equal votes are not tied
+            scores = np.dot(np.transpose(confidence), self._V)
                 
-                # initiate current confidence and OvO classifier
-                this_confidence = confidence[this_dat]
-                OvO_classifier = np.zeros((self.nclasses, 1))
-                
-                # compare with other OvO calasifiers
-                for class_idx, OvO_index in enumerate(self.OvO_indices):
-                    
-                    # classify
-                    if this_confidence[class_idx] > 0:
-                        OvO_classifier[OvO_index[0]] += 1
-                    else:
-                        OvO_classifier[OvO_index[1]] += 1
-                        
-                 # maximize decision
-                decisions[this_dat] = np.argmax(OvO_classifier)
-                
-            return decisions  
+            # maximize decision
+            decisions = np.argmax(scores, axis=1)
+            
+        self._predictions = decisions
+        return decisions
             
     
     def test_error(self):
@@ -200,16 +457,15 @@ class Kernel_perceptron:
         conf_mtx = np.zeros((self.nclasses, self.nclasses))
         
         # predict on the test set
-        predictions = self.predict(self.test_set.data)
+        predictions = self.predict(self.test_set.data).astype(int)
+        y = self.test_set.labels.astype(int)
         
-        # loop through each prediction and increment conf_mtx when wrong
-        for idx, pred in enumerate(predictions):
-            y = self.test_set.labels[idx]
-            if pred != y:
-                conf_mtx[int(y), int(pred)] += 1
+        # increment conf_mtx for every wrong prediction
+        wrong = predictions != y
+        np.add.at(conf_mtx, (y[wrong], predictions[wrong]), 1)
                 
-        # return normalized (percentage) conf_mtx
-        return np.divide(conf_mtx, np.transpose(counts))
+        # return normalized (percentage of each true class) conf_mtx
+        return np.divide(conf_mtx, counts[:, None])
     
     
     def count_mistake_vec(self):
@@ -221,11 +477,10 @@ class Kernel_perceptron:
         
         predictions = self.predict(self.test_set.data)
         
-        # loop through all predictions and count mistakes
-        for idx, pred in enumerate(predictions):
-            if pred != self.test_set.labels[idx]:
-                mistake_vec[self.test_indices[idx]] += 1
-                
+        # count mistakes at the kernel indices of the test set
+        wrong = predictions != self.test_set.labels
+        np.add.at(mistake_vec, np.asarray(self.test_indices)[wrong], 1)
+        
         return mistake_vec
                 
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Self-check of the blocked, packed and threaded training epochs of Kernel_perceptron
+against a naive per-sample perceptron. Data points have entries in {-1, 0, 1} so all
+kernel values and confidences are small integers, which are exact in single precision,
+and the coefficients must match exactly.
+
+Run with pytest, or directly: python test_kernel_perceptron.py
+"""
+
+import numpy as np
+
+from helper import LabelledDataset, polynomial_kernel
+from kernel_perceptron import Kernel_perceptron, _pack_symmetric, _unpack_rows
+
+
+def make_data(datasize=150, datadim=4, nclasses=4, seed=0):
+    """
+    Random data set with integer entries and labels in the first column
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.integers(-1, 2, size=(datasize, datadim)).astype(float)
+    labels = rng.integers(0, nclasses, size=datasize)
+    return np.column_stack([labels, data])
+
+
+def reference_epoch(classifier, K, labels, classification_method, OvO_indices):
+    """
+    One epoch of the plain online perceptron, one data point at a time
+    """
+    mistakes = 0
+
+    for data_idx in range(K.shape[0]):
+        confidence = np.dot(classifier, K[data_idx])
+        label = labels[data_idx]
+
+        if classification_method == 'OvA':
+            for this_class in range(classifier.shape[0]):
+                if confidence[this_class] > 0 and this_class != label:
+                    mistakes += 1
+                    classifier[this_class, data_idx] -= 1
+                elif confidence[this_class] <= 0 and this_class == label:
+                    mistakes += 1
+                    classifier[this_class, data_idx] += 1
+
+        elif classification_method == 'OvO':
+            for class_idx, this_pair in enumerate(OvO_indices):
+                if this_pair[0] == label and confidence[class_idx] <= 0:
+                    mistakes += 1
+                    classifier[class_idx, data_idx] += 1
+                if this_pair[1] == label and confidence[class_idx] > 0:
+                    mistakes += 1
+                    classifier[class_idx, data_idx] -= 1
+
+    return mistakes
+
+
+def check_training(classification_method, degree, packed_kernel, n_jobs, block_size, contiguous, epochs=4):
+    """
+    Train epoch by epoch and compare with the reference perceptron after every epoch
+    """
+    nclasses = 4
+    data = make_data(nclasses=nclasses)
+    kernel_mtx = polynomial_kernel(data[:, 1:], data[:, 1:], degree)
+
+    indices = np.arange(data.shape[0]) if contiguous else np.random.default_rng(1).permutation(data.shape[0])
+    train_indices, test_indices = indices[:120], indices[120:]
+    train_set = LabelledDataset(data[train_indices])
+    test_set = LabelledDataset(data[test_indices])
+
+    kp = Kernel_perceptron(train_set, test_set, train_indices, test_indices, nclasses, kernel_mtx, degree,
+                           classification_method, packed_kernel=packed_kernel)
+
+    K = kernel_mtx[np.ix_(train_indices, train_indices)].astype(float)
+    K_test = kernel_mtx[np.ix_(train_indices, test_indices)].astype(float)
+    labels = train_set.labels.astype(int)
+    classifier = np.zeros(kp.classifier.shape)
+    OvO_indices = getattr(kp, 'OvO_indices', None)
+
+    for epoch in range(epochs):
+
+        # with max_epochs=1 every call to train runs exactly one epoch
+        train_error = kp.train(max_epochs=1, block_size=block_size, n_jobs=n_jobs)
+        mistakes = reference_epoch(classifier, K, labels, classification_method, OvO_indices)
+
+        setting = (classification_method, degree, packed_kernel, n_jobs, block_size, contiguous, epoch)
+        assert np.array_equal(kp.classifier, classifier), setting
+        assert train_error == mistakes/train_set.size, setting
+        assert np.array_equal(kp.support_mask, np.any(classifier != 0, axis=0)), setting
+        assert np.array_equal(kp._confidence(), np.dot(classifier, K_test)), setting
+
+
+def test_training_matches_reference():
+    for classification_method in ['OvA', 'OvO']:
+        for degree in [2, 3, 5]:
+            for packed_kernel, n_jobs in [(False, 1), (False, 3), (True, 1)]:
+                for block_size in [None, 7]:
+                    check_training(classification_method, degree, packed_kernel, n_jobs, block_size,
+                                   contiguous=False)
+
+
+def test_contiguous_training_matches_reference():
+    for classification_method in ['OvA', 'OvO']:
+        check_training(classification_method, 3, False, 1, 7, contiguous=True)
+
+
+def test_packed_kernel_refuses_threads():
+    data = make_data()
+    kernel_mtx = polynomial_kernel(data[:, 1:], data[:, 1:], 2)
+    indices = np.random.default_rng(1).permutation(data.shape[0])
+    train_indices, test_indices = indices[:120], indices[120:]
+    
+    kp = Kernel_perceptron(LabelledDataset(data[train_indices]), LabelledDataset(data[test_indices]),
+                           train_indices, test_indices, 4, kernel_mtx, 2, packed_kernel=True)
+    
+    try:
+        kp.train(max_epochs=1, n_jobs=2)
+    except ValueError:
+        return
+    raise AssertionError("training with packed_kernel=True and n_jobs=2 did not raise")
+
+
+def test_unpack_rows():
+    rng = np.random.default_rng(2)
+    kernel_mtx = rng.random((40, 40))
+    kernel_mtx = kernel_mtx + np.transpose(kernel_mtx)
+    indices = rng.permutation(40)[:31]
+
+    packed = _pack_symmetric(kernel_mtx, indices)
+    K = kernel_mtx[np.ix_(indices, indices)].astype(np.float32)
+
+    for start, stop in [(0, 1), (0, 7), (7, 14), (14, 31), (30, 31), (0, 31)]:
+        assert np.array_equal(_unpack_rows(packed, indices.size, start, stop), K[start:stop]), (start, stop)
+
+
+if __name__ == '__main__':
+    test_training_matches_reference()
+    test_contiguous_training_matches_reference()
+    test_packed_kernel_refuses_threads()
+    test_unpack_rows()
+    print('all checks passed')